@@ -5,83 +5,174 @@ import argparse
 import hashlib
 import json
 import logging
-import pathlib
-import pickle
+import os
 import re
-import subprocess
 import time
+from operator import attrgetter
 
 import nagiosplugin  # type: ignore
 
 logger = logging.getLogger("nagiosplugin")
 
-CHECK_NAME = pathlib.Path(__file__).name
+CHECK_NAME = os.path.basename(__file__)
 STATE_FILE_PATH = "/tmp"
+PROC_NET_DEV_PATH = "/proc/net/dev"
+SYS_CLASS_NET_PATH = "/sys/class/net"
+BOOT_ID_PATH = "/proc/sys/kernel/random/boot_id"
+_HUMAN_SIZE_RE = re.compile(r"\A(\d+)([KMGT]?)\Z", flags=re.I)
+_UNITS_1000 = ("", "K", "M", "G", "T")
+_UNITS_1024 = ("", "Ki", "Mi", "Gi", "Ti")
+_DIVISORS_1000 = tuple(1000**power for power in range(len(_UNITS_1000)))
+_DIVISORS_1024 = tuple(1024**power for power in range(len(_UNITS_1024)))
+_UNIT_POWER = {unit: power for power, unit in enumerate(_UNITS_1000)}
+# Arguments which identify the state file, in declaration order; other arguments like the
+# verbosity or values derived from these ones must not affect it
+_STATE_ARGS = (
+    "type",
+    "exclude_type",
+    "name",
+    "exclude_name",
+    "down",
+    "include_netns",
+    "bytes",
+    "warning",
+    "critical",
+)
 
 
 def prettify_size(size, multiplier):
-    binary_str = "i" if multiplier == 1024 else ""
-    for unit in ("", f"K{binary_str}", f"M{binary_str}", f"G{binary_str}"):
-        if abs(size) < multiplier:
-            return f"{size:.1f}{unit}"
-        size /= multiplier
-    return f"{size:.1f}T{binary_str}"
+    integer_size = int(abs(size))
+    # Index of the largest unit which is not greater than the size, computed without a loop
+    if multiplier == 1024:
+        units, divisors = _UNITS_1024, _DIVISORS_1024
+        power = (integer_size.bit_length() - 1) // 10
+    else:
+        units, divisors = _UNITS_1000, _DIVISORS_1000
+        power = (len(str(integer_size)) - 1) // 3
+    power = min(max(power, 0), len(units) - 1)
+    return f"{size / divisors[power]:.1f}{units[power]}"
 
 
 def human_size(string):
-    match = re.search(r"\A(\d+)([KMGT]?)\Z", string, flags=re.I)
+    match = _HUMAN_SIZE_RE.match(string)
     if not match:
         raise argparse.ArgumentTypeError(
             f"invalid argument: {string}, must be an integer, "
             "optionally followed by K, M, G or T (case-insensitive)"
         )
     value, unit = match.groups()
-    units = ("", "K", "M", "G", "T")
-    power = units.index(unit.upper())
-    return int(value), power
+    return int(value), _UNIT_POWER[unit.upper()]
 
 
-def run_command(command):
+def run_command(command, log_output=False):
+    # ip is not needed in the common case, don't pay for the import of subprocess at startup
+    import subprocess  # pylint: disable=import-outside-toplevel
+
     try:
         proc = subprocess.run(
             command,
             check=True,
-            text=True,
             capture_output=True,
         )
     except subprocess.CalledProcessError as exc:
         raise nagiosplugin.CheckError(
-            f"command {command} exited with status {exc.returncode}: {exc.stderr!r}"
+            f"command {command} exited with status {exc.returncode}: "
+            f"{exc.stderr.decode(errors='replace')!r}"
         )
-    logger.debug("Output from %s: %s", " ".join(command), proc.stdout)
+    # Output is kept as bytes, only decode it if it is going to be logged
+    if log_output:
+        logger.debug("Output from %s: %s", " ".join(command), proc.stdout.decode(errors="replace"))
     return proc
 
 
-class Traffic(nagiosplugin.Resource):
+def get_boot_id():
+    # Monotonic clock values are only comparable within the same boot
+    with open(BOOT_ID_PATH, encoding="utf-8") as boot_id_file:
+        return boot_id_file.read().strip()
+
+
+class Traffic(nagiosplugin.Resource):  # pylint: disable=too-many-instance-attributes
     def __init__(self, args, args_hash):
         self.args = args
         self.args_hash = args_hash
         self.old_state = {}
         self.current_state = {"statistics": {}}
+        self._type_set = set(args.type) if args.type else None
+        self._exclude_type_set = set(args.exclude_type)
+        self._name_re = re.compile(args.name) if args.name else None
+        self._exclude_name_re = re.compile(args.exclude_name) if args.exclude_name else None
+        self._unit = "B" if args.bytes else "b"
+        self._multiplier = 1 if args.bytes else 8
+        # Converts a difference of bytes into a bandwidth, set once the time delta is known
+        self._rate_factor = 0.0
+        # nagiosplugin filters log records in its handler, the logger itself always has the
+        # DEBUG level so its isEnabledFor can't be used to skip work, -vv enables INFO messages
+        self._log_info = args.verbose >= 2
+        self._log_debug = args.verbose >= 3
+
+    @staticmethod
+    def _read_sysfs_attribute(interface_name, attribute):
+        path = f"{SYS_CLASS_NET_PATH}/{interface_name}/{attribute}"
+        with open(path, encoding="utf-8") as attribute_file:
+            return attribute_file.read().strip()
+
+    def _get_default_netns_interfaces(self):
+        """Get interfaces from /proc/net/dev and sysfs, without running ip"""
+        interfaces = []
+        with open(PROC_NET_DEV_PATH, encoding="utf-8") as proc_file:
+            # The first two lines are headers
+            for line in proc_file.readlines()[2:]:
+                interface_name, _, counters_str = line.partition(":")
+                interface_name = interface_name.strip()
+                counters = counters_str.split()
+                try:
+                    operstate = self._read_sysfs_attribute(interface_name, "operstate")
+                except FileNotFoundError:
+                    logger.debug("Interface %s disappeared while reading sysfs", interface_name)
+                    continue
+                interfaces.append(
+                    {
+                        "ifname": interface_name,
+                        "operstate": operstate.upper(),
+                        # Only ip knows the kind of interface, it is not needed here
+                        "link_type": None,
+                        "stats64": {
+                            "rx": {"bytes": int(counters[0])},
+                            "tx": {"bytes": int(counters[8])},
+                        },
+                    }
+                )
+        logger.debug("Interfaces read from %s: %s", PROC_NET_DEV_PATH, interfaces)
+        return interfaces
 
     def _get_interfaces(self):
+        # The kind of interface is only available with ip, it is needed by type filters and
+        # displayed in verbose output
+        needs_details = self._type_set is not None or bool(self._exclude_type_set) or self._log_info
         netns_info = []
         if self.args.include_netns:
-            command_output = run_command(["ip", "-json", "netns", "list"]).stdout
+            command_output = run_command(
+                ["ip", "-json", "netns", "list"], log_output=self._log_debug
+            ).stdout
             # If there are no namespaces, no JSON is returned
             if command_output:
                 netns_info = json.loads(command_output)
         interfaces = []
         for netns in [None] + netns_info:
-            if netns is None:
-                command = ["ip"]
-                netns_name = None
+            netns_name = None if netns is None else netns["name"]
+            if netns_name is None and not needs_details:
+                interfaces_by_netns = self._get_default_netns_interfaces()
             else:
-                command = ["sudo", "-n", "ip"]
-                netns_name = netns["name"]
-                command += ["-netns", netns_name]
-            command += ["-details", "-statistics", "-json", "link", "show"]
-            interfaces_by_netns = json.loads(run_command(command).stdout)
+                if netns_name is None:
+                    command = ["ip"]
+                else:
+                    command = ["sudo", "-n", "ip", "-netns", netns_name]
+                if needs_details:
+                    command.append("-details")
+                command += ["-statistics", "-json", "link", "show"]
+                interfaces_by_netns = json.loads(
+                    run_command(command, log_output=self._log_debug).stdout
+                )
             for interface in interfaces_by_netns:
                 interface["netns_name"] = netns_name
                 if netns_name is None:
@@ -89,7 +180,7 @@ class Traffic(nagiosplugin.Resource):
                 else:
                     interface["pretty_ifname"] = f"{netns_name}/{interface['ifname']}"
             interfaces.extend(interfaces_by_netns)
-        execution_time = time.time()
+        execution_time = time.monotonic()
         return execution_time, interfaces
 
     def _include_interface(self, interface):
@@ -107,7 +198,7 @@ class Traffic(nagiosplugin.Resource):
             )
             return False
         # Exclusions first
-        if interface_type in self.args.exclude_type:
+        if interface_type in self._exclude_type_set:
             logger.info(
                 "[-] Skipping interface %s (type %s matches %s)",
                 interface_pretty_name,
@@ -115,7 +206,7 @@ class Traffic(nagiosplugin.Resource):
                 self.args.exclude_type,
             )
             return False
-        if self.args.exclude_name and re.search(self.args.exclude_name, interface_name):
+        if self._exclude_name_re and self._exclude_name_re.search(interface_name):
             logger.info(
                 "[-] Skipping interface %s (name matches %s)",
                 interface_pretty_name,
@@ -123,28 +214,26 @@ class Traffic(nagiosplugin.Resource):
             )
             return False
         # Then inclusions, if any
-        inclusion_tests = []
-        if self.args.type:
-            inclusion_tests.append(("type", self.args.type, interface_type in self.args.type))
-        if self.args.name:
-            inclusion_tests.append(
-                ("name", self.args.name, re.search(self.args.name, interface_name))
-            )
-        if inclusion_tests:
-            messages = []
-            tests_match = True
-            for test_type, test_str, test_result in inclusion_tests:
-                verb = "matches" if test_result else "does not match"
-                additional_info = f" {interface_type}" if test_type == "type" else ""
-                messages.append(f"{test_type}{additional_info} {verb} {test_str}")
-                # We must match all conditions
-                tests_match = tests_match and test_result
-            logger.info(
-                "%s interface %s (%s)",
-                "[+] Including" if tests_match else "[-] Skipping",
-                interface_pretty_name,
-                ", ".join(messages),
-            )
+        if self._type_set is not None or self._name_re is not None:
+            type_match = self._type_set is None or interface_type in self._type_set
+            name_match = self._name_re is None or self._name_re.search(interface_name) is not None
+            # We must match all conditions
+            tests_match = type_match and name_match
+            # Only build the detailed message if it is going to be logged
+            if self._log_info:
+                messages = []
+                if self._type_set is not None:
+                    verb = "matches" if type_match else "does not match"
+                    messages.append(f"type {interface_type} {verb} {self.args.type}")
+                if self._name_re is not None:
+                    verb = "matches" if name_match else "does not match"
+                    messages.append(f"name {verb} {self.args.name}")
+                logger.info(
+                    "%s interface %s (%s)",
+                    "[+] Including" if tests_match else "[-] Skipping",
+                    interface_pretty_name,
+                    ", ".join(messages),
+                )
             return tests_match
         # If there are no inclusions, implicitly include the interface
         logger.info(
@@ -154,87 +243,92 @@ class Traffic(nagiosplugin.Resource):
         )
         return True
 
-    def _load_cookie(self, state_file):
-        with nagiosplugin.Cookie(str(state_file)) as cookie:
-            self.old_state = cookie
-            if self.old_state:
-                logger.debug("Loaded old metrics from %s", state_file)
-            else:
-                yield nagiosplugin.Metric(
-                    name="Warn",
-                    value={"message": f"no data in state file {state_file}, first run?"},
-                    context="metadata",
-                )
-
-    @classmethod
-    def _save_cookie(cls, state_file, state):
-        with nagiosplugin.Cookie(str(state_file)) as cookie:
-            # We can't just copy the dict to the cookie
-            for key, value in state.items():
-                cookie[key] = value
-
-    def _probe_interface(self, interface):
+    def _probe_interface(self, interface, first_run):
         interface_name = interface["pretty_ifname"]
-        self.current_state["statistics"][interface_name] = {}
-        for direction in ("rx", "tx"):
-            self.current_state["statistics"][interface_name][direction] = interface["stats64"][
-                direction
-            ]["bytes"]
+        stats = interface["stats64"]
+        current_bytes = {"rx": stats["rx"]["bytes"], "tx": stats["tx"]["bytes"]}
+        self.current_state["statistics"][interface_name] = current_bytes
         # Two cases where we can't compute the bandwidth:
         # 1. no old data, e.g. first run
-        if not self.old_state:
+        if first_run:
             return
         # 2. new interface
-        if self.old_state and interface_name not in self.old_state["statistics"]:
+        # Reboots are detected beforehand, in which case there is no old data
+        old_bytes = self.old_state["statistics"].get(interface_name)
+        if old_bytes is None:
             yield nagiosplugin.Metric(
                 name="Warn",
                 value={"message": f"no data in state file for {interface_name}, new interface?"},
                 context="metadata",
             )
             return
-        time_delta = self.current_state["execution_time"] - self.old_state["execution_time"]
-        if self.args.bytes:
-            unit = "B"
-            multiplier = 1
-        else:
-            unit = "b"
-            multiplier = 8
-        for direction, current_bytes in self.current_state["statistics"][interface_name].items():
-            bandwidth = (
-                multiplier
-                * (current_bytes - self.old_state["statistics"][interface_name][direction])
-                / time_delta
-            )
-            if bandwidth < 0:
+        for direction, direction_bytes in current_bytes.items():
+            bytes_delta = direction_bytes - old_bytes[direction]
+            if bytes_delta < 0:
                 yield nagiosplugin.Metric(
                     name="Warn",
                     value={
                         "message": f"Counter for {interface_name}/{direction} is decreasing,"
-                        " this could be caused by a reboot"
+                        " the interface was probably recreated"
                     },
                     context="metadata",
                 )
                 return
             yield nagiosplugin.Metric(
-                name=f"{interface_name}_{direction}", value=bandwidth, uom=unit, context=direction
+                name=f"{interface_name}_{direction}",
+                value=bytes_delta * self._rate_factor,
+                uom=self._unit,
+                context=direction,
             )
 
     def probe(self):
-        state_file = pathlib.Path(STATE_FILE_PATH) / f".{CHECK_NAME}_{self.args_hash}"
-        yield from self._load_cookie(state_file)
-        execution_time, interfaces = self._get_interfaces()
-        if not interfaces:
-            raise nagiosplugin.CheckError("No interfaces found")
-        filtered_interfaces = [e for e in interfaces if self._include_interface(e)]
-        logger.info(
-            "Included interfaces: %s", ", ".join(e["pretty_ifname"] for e in filtered_interfaces)
-        )
-        if not filtered_interfaces:
-            raise nagiosplugin.CheckError("No matching interfaces found after applying filters")
-        self.current_state["execution_time"] = execution_time
-        for interface in filtered_interfaces:
-            yield from self._probe_interface(interface)
-        self._save_cookie(state_file, self.current_state)
+        state_file = f"{STATE_FILE_PATH}/.{CHECK_NAME}_{self.args_hash}"
+        # The state file is only opened once: it is read at the start of the probe and the new
+        # state is committed when the context is left without an exception
+        with nagiosplugin.Cookie(state_file) as cookie:
+            self.old_state = dict(cookie)
+            self.current_state["boot_id"] = get_boot_id()
+            if not self.old_state:
+                yield nagiosplugin.Metric(
+                    name="Warn",
+                    value={"message": f"no data in state file {state_file}, first run?"},
+                    context="metadata",
+                )
+            elif self.old_state.get("boot_id") != self.current_state["boot_id"]:
+                yield nagiosplugin.Metric(
+                    name="Warn",
+                    value={"message": "reboot detected since last run, ignoring old metrics"},
+                    context="metadata",
+                )
+                self.old_state = {}
+            else:
+                logger.debug("Loaded old metrics from %s", state_file)
+            execution_time, interfaces = self._get_interfaces()
+            if not interfaces:
+                raise nagiosplugin.CheckError("No interfaces found")
+            self.current_state["execution_time"] = execution_time
+            # Without old data, only the current counters are stored
+            first_run = not self.old_state
+            if not first_run:
+                self._rate_factor = self._multiplier / (
+                    execution_time - self.old_state["execution_time"]
+                )
+            # Interfaces are filtered and probed in a single pass
+            any_included = False
+            included_names = [] if self._log_info else None
+            for interface in interfaces:
+                if not self._include_interface(interface):
+                    continue
+                any_included = True
+                if included_names is not None:
+                    included_names.append(interface["pretty_ifname"])
+                yield from self._probe_interface(interface, first_run)
+            if included_names is not None:
+                logger.info("Included interfaces: %s", ", ".join(included_names))
+            if not any_included:
+                raise nagiosplugin.CheckError("No matching interfaces found after applying filters")
+            cookie.clear()
+            cookie.update(self.current_state)
 
 
 class MetadataContext(nagiosplugin.Context):
@@ -353,17 +447,15 @@ class TrafficSummary(nagiosplugin.Summary):
     def problem(self, results):
         messages = []
         # Worst results first
-        for result in sorted(results, key=lambda x: x.state, reverse=True):
+        for result in sorted(results, key=attrgetter("state"), reverse=True):
             if result.state == nagiosplugin.state.Ok:
                 continue
-            if result.context and result.context.name in ("rx", "tx"):
-                human_readable_value = prettify_size(
-                    result.metric.value, 1024 if result.metric.uom == "B" else 1000
-                )
-                messages.append(
-                    f"{result.metric.name} ="
-                    f" {human_readable_value}{result.metric.uom}/s ({result.hint})"
-                )
+            context = result.context
+            if context and context.name in ("rx", "tx"):
+                metric = result.metric
+                uom = metric.uom
+                human_readable_value = prettify_size(metric.value, 1024 if uom == "B" else 1000)
+                messages.append(f"{metric.name} = {human_readable_value}{uom}/s ({result.hint})")
             else:
                 messages.append(result.hint)
         return ", ".join(messages)
@@ -372,11 +464,8 @@ class TrafficSummary(nagiosplugin.Summary):
 @nagiosplugin.guarded
 def main(args):
     # Unique identifier used to store check state
-    relevant_args = []
-    for arg, arg_val in sorted(vars(args).items()):
-        if arg not in ("verbose",):
-            relevant_args.append((arg, arg_val))
-    args_hash = hashlib.sha1(pickle.dumps(relevant_args)).hexdigest()
+    relevant_args = json.dumps([(arg, getattr(args, arg)) for arg in _STATE_ARGS]).encode()
+    args_hash = hashlib.blake2b(relevant_args, digest_size=8).hexdigest()
     check = nagiosplugin.Check(
         Traffic(args, args_hash),
         MetadataContext("metadata"),